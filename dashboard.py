@@ -1,57 +1,165 @@
 # ====================================================
 # 1. Imports
 # ====================================================
+import os
+import time
+import hashlib
 import pandas as pd
 import yfinance as yf
 import streamlit as st
-from datetime import date
+from datetime import date, timedelta
 import plotly.express as px
+# curl_cffi est installé avec yfinance (>= 0.2.54), qui n'accepte que ce type de session
+from curl_cffi import requests as curl_requests
+
+# Configuration de la page : une seule fois, avant toute autre commande Streamlit
+st.set_page_config(page_title="Cross-Asset Market Monitor", layout="wide")
 
 # ====================================================
 # 2. Function Definitions
 # ====================================================
 
+@st.cache_resource
+def get_session():
+    # Session HTTP partagée : connexions keep-alive réutilisées entre les reruns
+    return curl_requests.Session(impersonate="chrome")
+
 def download_data(tickers, start_date=None, end_date=None):
-    all_data = []
-    valid_tickers = []
-    failed_tickers = []
-
-    for t in tickers:
-        try:
-            df = yf.download(t, start=start_date, end=end_date, progress=False)["Close"]
-            if not df.empty:
-                df.name = t
-                all_data.append(df)
-                valid_tickers.append(t)
-            else:
-                failed_tickers.append(t)
-        except:
-            failed_tickers.append(t)
-
-    if all_data:
-        data = pd.concat(all_data, axis=1)
-        return data, valid_tickers, failed_tickers
+    # Un seul appel groupé : yfinance télécharge les tickers en parallèle.
+    # yfinance intercepte lui-même les erreurs par ticker (limite de débit comprise) et renvoie
+    # alors des colonnes vides : seuls ces tickers sont retentés, avec backoff
+    frames = []
+    action_tickers = set()
+    remaining = list(tickers)
+    for attempt in range(MAX_RETRIES):
+        if attempt:
+            time.sleep(RETRY_BACKOFF * 2 ** (attempt - 1))
+        raw = yf.download(
+            remaining,
+            start=start_date,
+            end=end_date,
+            auto_adjust=True,
+            actions=True,
+            progress=False,
+            threads=True,
+            session=get_session(),
+        )
+        if raw.empty:
+            # Aucune barre sur la période : réponse valide, rien à retenter
+            break
+        if not isinstance(raw.columns, pd.MultiIndex):
+            raw.columns = pd.MultiIndex.from_product([raw.columns, remaining[:1]])
+
+        # Un dividende ou un split sur la période modifie tous les prix ajustés antérieurs du ticker
+        actions = raw.reindex(columns=["Dividends", "Stock Splits"], level=0)
+        flagged = (actions.fillna(0) != 0).any()
+        action_tickers.update(flagged[flagged].index.get_level_values(-1))
+
+        # Un ticker est en échec si sa colonne est absente ou entièrement vide
+        close = raw["Close"].reindex(columns=remaining)
+        all_nan = close.isna().all()
+        frames.append(close.loc[:, ~all_nan])
+        remaining = all_nan[all_nan].index.tolist()
+        if not remaining:
+            break
+
+    close = pd.concat(frames, axis=1) if frames else pd.DataFrame()
+    valid_tickers = [t for t in tickers if t in close.columns]
+    failed_tickers = [t for t in tickers if t not in valid_tickers]
+    action_tickers = [t for t in tickers if t in action_tickers]
+
+    if valid_tickers:
+        # float32 suffit pour l'affichage et divise par deux la mémoire
+        return close[valid_tickers].astype("float32"), valid_tickers, failed_tickers, action_tickers
     else:
-        return pd.DataFrame(), [], failed_tickers
+        return pd.DataFrame(), [], failed_tickers, action_tickers
+
+def cache_path(tickers):
+    # Un fichier parquet par ensemble de tickers
+    key = hashlib.md5(",".join(sorted(tickers)).encode()).hexdigest()
+    return os.path.join(DATA_DIR, f"{key}.parquet")
+
+@st.cache_resource(ttl=3600, show_spinner="Updating market data...")
+def update_data(tickers, start_date=None, end_date=None):
+    path = cache_path(tickers)
+
+    data = pd.DataFrame()
+    if os.path.exists(path):
+        data = pd.read_parquet(path, engine="pyarrow")
+
+    if not data.empty:
+        # Tickers absents du fichier ou dont l'historique ne couvre que les derniers jours
+        # (échec lors du premier téléchargement) : à retélécharger depuis start_date
+        stored = data.reindex(columns=list(tickers)).notna()
+        late_cutoff = data.index.max() - pd.Timedelta(days=LATE_DAYS)
+        missing = [t for t in tickers if not stored[t].any() or stored[t].idxmax() > late_cutoff]
+        present = tuple(t for t in tickers if t not in missing)
+
+        # Ne télécharger que les jours postérieurs à la dernière date stockée
+        new_start = data.index.max().date() + timedelta(days=1)
+        # end_date est exclu par yfinance : rien à télécharger si aucun jour ouvré ne précède end_date
+        end = date.fromisoformat(end_date) if end_date else date.today()
+        pending = new_start < end and len(pd.bdate_range(new_start, end - timedelta(days=1))) > 0
+        changed = False
+        if present and pending:
+            new_data, _, _, action_tickers = download_data(present, new_start.strftime("%Y-%m-%d"), end_date)
+            # Dividende ou split : l'historique stocké de ces tickers n'est plus ajusté comme celui de Yahoo
+            missing += action_tickers
+            if not new_data.empty:
+                tail_start = new_data.index.min()
+                merged = pd.concat([data, new_data]).sort_index()
+                merged = merged[~merged.index.duplicated(keep="last")]
+                # Réécrire le fichier seulement si les nouvelles lignes changent réellement les données
+                changed = hash_frame(merged.loc[tail_start:]) != hash_frame(data.loc[tail_start:])
+                data = merged
+        elif not present:
+            data = pd.DataFrame()
+
+        if not data.empty and missing:
+            backfill, _, _, _ = download_data(tuple(missing), start_date, end_date)
+            if not backfill.empty:
+                data = data.drop(columns=backfill.columns, errors="ignore").join(backfill, how="outer")
+                changed = True
+
+        if changed:
+            data.to_parquet(path, compression="zstd", engine="pyarrow")
+
+    if data.empty:
+        data, _, _, _ = download_data(tickers, start_date, end_date)
+        if not data.empty:
+            os.makedirs(DATA_DIR, exist_ok=True)
+            data.to_parquet(path, compression="zstd", engine="pyarrow")
+
+    if data.empty:
+        # Lever plutôt que renvoyer un résultat vide : Streamlit ne met pas les exceptions en cache
+        raise RuntimeError("No market data could be downloaded.")
 
+    all_nan = data.reindex(columns=list(tickers)).isna().all()
+    valid_tickers = all_nan[~all_nan].index.tolist()
+    failed_tickers = all_nan[all_nan].index.tolist()
+    # Renommage fait une seule fois ici : les données en cache portent déjà les noms lisibles
+    data = data[valid_tickers].rename(columns=asset_names)
+    return data, valid_tickers, failed_tickers, time.time()
+
+@st.cache_data(ttl=3600)
 def preprocess(data):
-    return data.ffill().dropna(how="all")
+    # Supprimer d'abord les lignes vides pour que ffill parcoure moins de lignes
+    return data.dropna(how="all").ffill()
 
 def normalize(prices):
-    returns = prices.pct_change().fillna(0)
-    cum_returns = (1 + returns).cumprod()
-    return cum_returns
+    # Rebase chaque série sur sa première valeur disponible (équivalent au cumprod des rendements)
+    first = prices.bfill().iloc[0]
+    return prices.div(first)
 
 def plot(data, title):
-    df = data.reset_index().melt(id_vars="Date", var_name="Ticker", value_name="Price")
+    # Format large : Plotly colore par colonne, sans reshape en format long
     fig = px.line(
-        df,
-        x="Date",
-        y="Price",
-        color="Ticker",
+        data,
+        x=data.index,
+        y=data.columns,
         title=title,
         template="plotly_dark",
-        hover_data={"Price": ":.2f", "Date": True, "Ticker": True},
+        labels={"value": "Price", "variable": "Ticker"},
     )
     fig.update_layout(
         plot_bgcolor="#0E1117",
@@ -61,41 +169,56 @@ def plot(data, title):
         hoverlabel=dict(bgcolor="rgba(30,30,30,0.8)", font_size=12),
         legend=dict(orientation="h", yanchor="bottom", y=-0.25, xanchor="center", x=0.5),
     )
-    fig.update_traces(line=dict(width=1.2))
+    fig.update_traces(line=dict(width=1.2), yhoverformat=".2f")
     return fig
 
-def create_dashboard(data, title):
-    if data.empty:
-        st.error("No valid data available to display.")
-        return
+def hash_frame(df):
+    # Hash vectorisé du DataFrame (colonnes incluses) pour éviter le hachage générique de Streamlit
+    return tuple(df.columns), int(pd.util.hash_pandas_object(df).sum())
+
+@st.cache_data(ttl=3600, max_entries=32, hash_funcs={pd.DataFrame: hash_frame})
+def build_fig(prices, title):
+    # Rebase de la fenêtre sur sa première ligne : rendements cumulés depuis le début du filtre
+    return plot(normalize(prices), title)
 
+@st.fragment
+def filter_and_plot(data, title):
     min_date = data.index.min().date()
     max_date = data.index.max().date()
 
-    # Sidebar filter pour les tickers
-    cols = st.sidebar.multiselect(
+    # Filtres dans le fragment : une interaction ne relance que ce bloc, pas tout le script
+    # (st.sidebar n'est pas utilisable depuis un fragment)
+    col_assets, col_dates = st.columns([3, 1])
+    cols = col_assets.multiselect(
         "Select assets to display:",
         options=data.columns.tolist(),
         default=data.columns.tolist()
     )
 
-    date_range = st.sidebar.date_input("Date range", [min_date, max_date])
+    date_range = col_dates.date_input("Date range", [min_date, max_date])
     if len(date_range) == 2:
         start, end = date_range
     else:
         start, end = min_date, max_date
 
-    mask = (data.index.date >= start) & (data.index.date <= end)
-    data_filtered = data.loc[mask, cols]
+    # Slicing sur l'index trié (recherche binaire) plutôt qu'un masque sur .index.date
+    data_filtered = data.loc[pd.Timestamp(start):pd.Timestamp(end), cols]
 
     if data_filtered.empty:
         st.warning("No data available for the selected range or assets.")
         return
 
-    fig = plot(normalize(data_filtered), title)
-    st.title(title)
+    fig = build_fig(data_filtered, title)
     st.plotly_chart(fig, use_container_width=True)
 
+def create_dashboard(data, title):
+    if data.empty:
+        st.error("No valid data available to display.")
+        return
+
+    st.title(title)
+    filter_and_plot(data, title)
+
 # ====================================================
 # 3. Main Workflow
 # ====================================================
@@ -127,9 +250,18 @@ asset_names = {
     "^TYX": "30Y Treasury Yield"
 }
 
+DATA_DIR = "data"
+LATE_DAYS = 30  # historique plus court : ticker à retélécharger depuis start_date
+MAX_RETRIES = 3
+FAILED_RETRY_SECONDS = 300  # délai minimal avant de retenter les tickers en échec
+RETRY_BACKOFF = 0.5  # secondes, doublé à chaque nouvelle tentative
+
 start_date = "1980-01-01"
 end_date = date.today().strftime("%Y-%m-%d")
 
+# Univers complet des tickers : les tickers communs à plusieurs classes ne sont téléchargés qu'une fois
+all_tickers = tuple(sorted(set().union(*asset_classes.values())))
+
 # --- Sidebar pour choisir la classe d'actifs ---
 st.sidebar.header("📊 Asset Class")
 selected_class = st.sidebar.radio(
@@ -138,12 +270,16 @@ selected_class = st.sidebar.radio(
 )
 
 # --- Télécharger et afficher les données pour la classe choisie ---
-tickers = asset_classes[selected_class]
-data, valid_tickers, failed_tickers = download_data(tickers, start_date, end_date)
+# end_date change chaque jour, ce qui invalide le cache au changement de date
+try:
+    universe, universe_tickers, universe_failed, fetched_at = update_data(all_tickers, start_date, end_date)
+except RuntimeError:
+    universe, universe_tickers, universe_failed, fetched_at = pd.DataFrame(), [], [], time.time()
+if universe_failed and time.time() - fetched_at > FAILED_RETRY_SECONDS:
+    # Résultat incomplet : nouvelle tentative au prochain rerun, au plus toutes les FAILED_RETRY_SECONDS
+    update_data.clear()
+data = universe[[asset_names.get(t, t) for t in asset_classes[selected_class] if t in universe_tickers]]
 if data.empty:
     st.error(f"No valid data for {selected_class}.")
 else:
-    data.columns = [asset_names.get(t, t) for t in valid_tickers]
-    data = preprocess(data)
-    cum_returns = normalize(data)
-    create_dashboard(cum_returns, f"📊 {selected_class} Dashboard")
+    create_dashboard(preprocess(data), f"📊 {selected_class} Dashboard")